@@ -1,5 +1,8 @@
 import json
 import os
+import time
+import hashlib
+from functools import lru_cache
 import toml
 import asyncio
 import edge_tts
@@ -20,30 +23,107 @@ except Exception as e:
     exit()
 
 # --- 函式定義 ---
-def translate_to_tw(text):
+MODEL_NAME = "gemini-1.5-flash"
+FALLBACK_MODEL = "gemini-pro"
+
+# 同時處理的景點數上限 (避免超過 Gemini / 雅婷的速率限制)
+MAX_CONCURRENCY = 8
+
+# 翻譯快取：同一段中文 + 同一個模型只翻一次，重跑時不再花 API 額度
+TRANS_CACHE_PATH = "data/.trans_cache.json"
+
+def _tw_prompt(text):
+    return f"請將此中文改寫為台語口語漢字，直接輸出結果：{text}"
+
+def _cache_key(text, model=MODEL_NAME):
+    # 以實際產出譯文的模型當 key，降級模型的結果不會被記成主模型的
+    return hashlib.sha256((model + text).encode("utf-8")).hexdigest()
+
+def _cached(cache, text):
+    """先找主模型的譯文，沒有再找降級模型的；都沒有回傳 None"""
+    return cache.get(_cache_key(text)) or cache.get(_cache_key(text, FALLBACK_MODEL))
+
+def _load_trans_cache():
+    try:
+        with open(TRANS_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_trans_cache(cache):
+    with open(TRANS_CACHE_PATH, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+
+@lru_cache(maxsize=None)
+def _llm(model):
+    # 每個模型只建一個 client，逐筆重試與降級時沿用同一條連線，不必每次重新握手
+    return ChatGoogleGenerativeAI(model=model, temperature=0.7, google_api_key=GOOGLE_KEY)
+
+def _call_gemini(text):
+    """回傳 (譯文, 使用的模型)，兩個模型都失敗時回傳 None"""
     try:
         # 如果更新後還是找不到 1.5-flash，這裡會自動降級用 gemini-pro
-        model_name = "gemini-1.5-flash"
-        
-        llm = ChatGoogleGenerativeAI(
-            model=model_name, 
-            temperature=0.7,
-            google_api_key=GOOGLE_KEY
-        )
-        return llm.invoke(f"請將此中文改寫為台語口語漢字，直接輸出結果：{text}").content.strip()
+        return _llm(MODEL_NAME).invoke(_tw_prompt(text)).content.strip(), MODEL_NAME
     except Exception as e:
         print(f"   ⚠️ 翻譯失敗 (原因: {e})")
-        print("   💡 嘗試降級使用 'gemini-pro'...")
+        print(f"   💡 嘗試降級使用 '{FALLBACK_MODEL}'...")
         try:
-            llm = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.7, google_api_key=GOOGLE_KEY)
-            return llm.invoke(f"請將此中文改寫為台語口語漢字，直接輸出結果：{text}").content.strip()
+            return _llm(FALLBACK_MODEL).invoke(_tw_prompt(text)).content.strip(), FALLBACK_MODEL
         except:
-            return text # 真的不行就回傳原文
+            return None
+
+def _call_gemini_batch(texts):
+    """一次送出所有待翻譯文字，只有一筆時直接走互動式呼叫"""
+    if len(texts) == 1:
+        return [_call_gemini(texts[0])]
+
+    try:
+        replies = _llm(MODEL_NAME).batch(
+            [_tw_prompt(t) for t in texts],
+            config={"max_concurrency": MAX_CONCURRENCY}
+        )
+        return [(r.content.strip(), MODEL_NAME) for r in replies]
+    except Exception as e:
+        print(f"   ⚠️ 批次翻譯失敗 (原因: {e})，改為逐筆翻譯...")
+        return [_call_gemini(t) for t in texts]
+
+def translate_batch_to_tw(texts):
+    cache = _load_trans_cache()
+    todo = list(dict.fromkeys(t for t in texts if _cached(cache, t) is None))
+
+    if todo:
+        print(f"   🌐 快取未命中 {len(todo)} 筆，呼叫 Gemini...")
+        for text, result in zip(todo, _call_gemini_batch(todo)):
+            if result is None:
+                continue # 失敗不寫入快取，下次重跑會再試
+            translation, model = result
+            cache[_cache_key(text, model)] = {
+                "original": text,
+                "translation": translation,
+                "model": model,
+                "ts": int(time.time())
+            }
+        _save_trans_cache(cache)
+
+    # 翻譯失敗的回傳 None，由呼叫端決定怎麼處理 (不要把原文當成台語存起來)
+    return [(_cached(cache, t) or {}).get("translation") for t in texts]
 
 async def gen_cn_mp3(text, path):
     print(f"   🎙️ 生成中文語音 (Edge TTS)...")
     communicate = edge_tts.Communicate(text, "zh-TW-HsiaoChenNeural")
-    await communicate.save(path)
+
+    # 邊收邊寫；先寫到 .part，完整收完才改名，
+    # 中途斷線不會留下被當成「已存在」的半截檔
+    tmp_path = f"{path}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    f.write(chunk["data"])
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 # ⭐️ 核心修正：SDK 改用 V1 網址
 def gen_tw_mp3_sdk(text, path):
@@ -75,6 +155,41 @@ def gen_tw_mp3_sdk(text, path):
         return False
 
 # --- 主程式 ---
+async def process_spot(key, info, sem, existing):
+    # existing: data/audio 的檔名集合，開始時掃一次，不必每個檔各 stat 一次
+    async with sem:
+        print(f"\n📍 處理：{info['name']}")
+
+        # 2. 中文路徑
+        cn_path = f"data/audio/{key}_cn.mp3"
+
+        # 3. 台語路徑；還沒有譯文 (翻譯失敗) 就先跳過，保留舊檔
+        tw_path = f"data/audio/{key}_tw.mp3"
+        tw_text = info.get('intro_tw')
+        jobs = []
+        if tw_text:
+            # 刪除舊檔
+            if f"{key}_tw.mp3" in existing:
+                os.remove(tw_path)
+                existing.discard(f"{key}_tw.mp3")
+            jobs.append(asyncio.to_thread(gen_tw_mp3_sdk, tw_text, tw_path))
+        else:
+            print("   ⚠️ 尚無台語譯文，先跳過台語語音 (重跑時會再翻譯)")
+
+        # 中文 (Edge TTS) 與台語 (雅婷 SDK) 同時生成
+        if f"{key}_cn.mp3" not in existing:
+            jobs.append(gen_cn_mp3(info['intro_cn'], cn_path))
+        results = await asyncio.gather(*jobs)
+
+        # 生成後同步更新集合 (中文失敗會直接拋例外，走不到這裡)
+        existing.add(f"{key}_cn.mp3")
+        if not tw_text:
+            return
+        if results[0]:
+            existing.add(f"{key}_tw.mp3")
+        else:
+            print(f"      ⚠️ {info['name']} 生成失敗 (請確認 Key 有 V1/V2 權限)")
+
 async def main():
     if not os.path.exists('data/spots.json'):
         print("❌ 找不到 data/spots.json")
@@ -85,34 +200,36 @@ async def main():
         data = json.load(f)
 
     print("🚀 開始處理資源 (V1 SDK 版)...")
-    
-    for key, info in data.items():
-        print(f"\n📍 處理：{info['name']}")
-        
-        # 1. 翻譯
-        if not info.get('intro_tw'):
-            info['intro_tw'] = translate_to_tw(info['intro_cn'])
 
-        # 2. 生成中文
-        cn_path = f"data/audio/{key}_cn.mp3"
-        if not os.path.exists(cn_path):
-            await gen_cn_mp3(info['intro_cn'], cn_path)
-        
-        # 3. 生成台語
-        tw_path = f"data/audio/{key}_tw.mp3"
-        
-        # 刪除舊檔
-        if os.path.exists(tw_path):
-            os.remove(tw_path)
-            
-        # 呼叫 SDK
-        success = gen_tw_mp3_sdk(info['intro_tw'], tw_path)
-        
-        if not success:
-            print("      ⚠️ 生成失敗 (請確認 Key 有 V1/V2 權限)")
+    # 只有新增翻譯時才需要回寫 spots.json
+    dirty = False
+
+    # 1. 翻譯：先收集所有缺台語的景點，一次批次送出
+    missing = [key for key, info in data.items() if not info.get('intro_tw')]
+    if missing:
+        print(f"🌐 批次翻譯 {len(missing)} 個景點...")
+        texts = [data[key]['intro_cn'] for key in missing]
+        # 同步 API，丟到執行緒避免卡住事件迴圈
+        for key, tw in zip(missing, await asyncio.to_thread(translate_batch_to_tw, texts)):
+            if tw is None:
+                print(f"   ⚠️ {data[key]['name']} 翻譯失敗，intro_tw 保持空白")
+                continue
+            data[key]['intro_tw'] = tw
+            dirty = True
+
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    existing = set(os.listdir("data/audio"))
+    tasks = [process_spot(key, info, sem, existing) for key, info in data.items()]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for key, result in zip(data, results):
+        if isinstance(result, Exception):
+            print(f"   ❌ {key} 處理失敗: {result}")
 
-    with open('data/spots.json', 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if dirty:
+        with open('data/spots.json', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    else:
+        print("\nℹ️ 翻譯沒有變動，不重寫 spots.json")
     print("\n🎉 全部處理完成！")
 
 if __name__ == "__main__":
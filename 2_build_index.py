@@ -1,24 +1,21 @@
 import os
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+from guide_core import make_embeddings, load_spots, build_faiss_index
+
+SOURCE_PATH = "data/rag_source.txt"
+SPOTS_PATH = "data/spots.json"
 
 def build():
-    if not os.path.exists("data/rag_source.txt"):
+    if not os.path.exists(SOURCE_PATH):
         print("❌ 找不到 data/rag_source.txt")
         return
 
     print("📚 讀取資料並建立索引...")
-    loader = TextLoader("data/rag_source.txt", encoding="utf-8")
-    docs = CharacterTextSplitter(chunk_size=300, chunk_overlap=50).split_documents(loader.load())
-    
+    spots = load_spots(SPOTS_PATH) if os.path.exists(SPOTS_PATH) else {}
+
     print("🧠 下載向量模型中 (第一次會比較久)...")
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    
-    db = FAISS.from_documents(docs, embeddings)
-    db.save_local("faiss_index")
+    # 建索引時一次丟 128 段進模型，減少逐段呼叫的額外開銷
+    build_faiss_index(SOURCE_PATH, spots, "faiss_index", make_embeddings(batch_size=128))
     print("✅ 索引建立完成！資料夾: faiss_index")
 
 if __name__ == "__main__":
-    build()
\ No newline at end of file
+    build()
@@ -1,18 +1,18 @@
 import streamlit as st
-import json
 import os
+import copy
 import time
+import hashlib
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import faiss
 import folium
+import numpy as np
 import paho.mqtt.client as mqtt
 from streamlit_folium import st_folium
-from streamlit_js_eval import get_geolocation
-from geopy.distance import geodesic
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from streamlit_js_eval import streamlit_js_eval
+import guide_core
 
 # --------------------------------------------------
 # Page config
@@ -22,7 +22,8 @@ st.set_page_config(page_title="虎科大智慧導覽", layout="wide")
 # --------------------------------------------------
 # CSS (優化手機版顯示)
 # --------------------------------------------------
-st.markdown("""
+# 元素每次 rerun 都要重新送出，否則樣式會消失；內容固定，前端比對後不會重排
+APP_CSS = """
 <style>
 .stButton button {
     background-color: #0055A4;
@@ -37,27 +38,64 @@ st.markdown("""
     display: none;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # --------------------------------------------------
 # Load data
 # --------------------------------------------------
-if not os.path.exists("data/spots.json"):
+SPOTS_PATH = "data/spots.json"
+
+if not os.path.exists(SPOTS_PATH):
     st.error("找不到 data/spots.json，請檢查檔案路徑。")
     st.stop()
 
-SPOTS = json.load(open("data/spots.json", "r", encoding="utf-8"))
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_spots(path, mtime):
+    # 每次 rerun 都會跑到這裡，只有 mtime 變了 (檔案被改) 才重新解析；
+    # cache_resource 直接回傳同一個 dict (唯讀使用)，不像 cache_data 每次都要反序列化一份副本
+    return guide_core.load_spots(path)
+
+SPOTS_MTIME = os.path.getmtime(SPOTS_PATH)
+SPOTS = load_spots(SPOTS_PATH, SPOTS_MTIME)
 
 TRIGGER_DIST = 150
+DEFAULT_CENTER = (23.7027, 120.4295)
 MOVE_THRESHOLD = 5  # 降低移動門檻以增加靈敏度
+GPS_EMA_ALPHA = 0.3  # GPS 平滑係數，壓掉原地不動時的飄移
+GPS_RERUN_MIN_SEC = 8  # 因移動觸發整頁重畫的最短間隔
+RERUN_DEBOUNCE_SEC = 1.5  # 背景觸發的整頁重跑最短間隔 (MQTT 與 GPS 合併)
+
+@st.cache_resource(max_entries=1)
+def build_spot_index(mtime):
+    """(景點 key 順序, 投影原點, KD-tree)，同樣只在 spots.json 變動時重建"""
+    return guide_core.build_spot_index(SPOTS, DEFAULT_CENTER)
+
+SPOT_INDEX = build_spot_index(SPOTS_MTIME)
+SPOT_KEYS = SPOT_INDEX[0]
+
+def nearest_spot(user_pos):
+    return guide_core.nearest_spot(SPOT_INDEX, user_pos)
 
 # --------------------------------------------------
 # Session state
 # --------------------------------------------------
 if "user_coords" not in st.session_state:
     st.session_state.user_coords = None
+# 最近一筆原始 GPS 讀值 (未平滑)
 if "last_coords" not in st.session_state:
     st.session_state.last_coords = None
+if "pos_ema" not in st.session_state:
+    st.session_state.pos_ema = None
+if "last_ema_time" not in st.session_state:
+    st.session_state.last_ema_time = 0.0
+if "last_gps_rerun" not in st.session_state:
+    st.session_state.last_gps_rerun = 0.0
+# 背景有事件但還沒整頁重跑
+if "rerun_pending" not in st.session_state:
+    st.session_state.rerun_pending = False
+if "last_rerun" not in st.session_state:
+    st.session_state.last_rerun = 0.0
 if "current_spot" not in st.session_state:
     st.session_state.current_spot = None
 if "mqtt_action" not in st.session_state:
@@ -69,37 +107,54 @@ if "audio_to_play" not in st.session_state:
     st.session_state.audio_to_play = None
 
 # --------------------------------------------------
-# MQTT (JSON 廣播模式)
+# MQTT (記憶體廣播模式)
 # --------------------------------------------------
 MQTT_BROKER = "broker.hivemq.com"
 MQTT_PORT = 1883
 MQTT_TOPIC = "nfu/tour/control"
-MQTT_FILE = "mqtt_broadcast.json"
+MQTT_DEDUP_SEC = 5  # 同一指令在這段時間內重複送達 (重送 / 多個發布端) 只算一次
+
+@st.cache_resource
+def get_mqtt_broadcast():
+    # 最新一筆廣播放在記憶體，跨 session 共用；各 session 依 last_mqtt_time 判斷是否看過，
+    # 不再經由暫存檔交換 (少了每次輪詢的 open/read，也沒有讀到寫一半檔案的問題)
+    return {"lock": threading.Lock(), "cmd": "", "timestamp": 0.0}
 
 @st.cache_resource
 def start_mqtt_listener():
+    broadcast = get_mqtt_broadcast()
+
     def on_connect(client, userdata, flags, rc, properties=None):
         client.subscribe(MQTT_TOPIC)
 
     def on_message(client, userdata, msg):
         try:
             payload = msg.payload.decode()
-            data = {
-                "cmd": payload,
-                "timestamp": time.time()
-            }
-            # 寫入暫存檔
-            with open(MQTT_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f)
-        except Exception:
+        except UnicodeDecodeError:
+            return
+        now = time.time()
+        with broadcast["lock"]:
+            if payload == broadcast["cmd"] and now - broadcast["timestamp"] < MQTT_DEDUP_SEC:
+                return
+            broadcast["cmd"] = payload
+            broadcast["timestamp"] = now
+
+    def on_socket_open(client, userdata, sock):
+        # 指令封包很小，關掉 Nagle 讓它一到就送出/收進，不等湊滿
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
             pass
 
+    # cache_resource：整個 process 只有這一條 broker 連線，所有 session 共用
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
+    client.on_socket_open = on_socket_open
 
     try:
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        # 連線 (DNS + TCP) 交給背景 loop 執行緒，第一個使用者不用等 broker；斷線也由它自動重連
+        client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
         client.loop_start()
     except Exception as e:
         print(f"MQTT Connect Error: {e}")
@@ -112,124 +167,351 @@ start_mqtt_listener()
 # RAG (錯誤處理增強)
 # --------------------------------------------------
 @st.cache_resource
+def get_embeddings():
+    # 整個 process 共用一份模型，不隨 load_rag 重建
+    embeddings = guide_core.make_embeddings()
+    # 先跑一次推論，把權重與 tokenizer 的延遲載入做掉，第一個問題不用等
+    embeddings.embed_query("暖機")
+    return embeddings
+
+CONTEXT_MIN_SIM = 0.3  # MiniLM 對中文的相似度偏低，門檻不宜設高
+
+RAG_SOURCE_PATH = "data/rag_source.txt"
+FAISS_DIR = "faiss_index"
+
 def load_rag():
-    if not os.path.exists("faiss_index"):
-        return "FAISS index missing"
+    if not os.path.exists(RAG_SOURCE_PATH):
+        return "RAG source missing: data/rag_source.txt"
     if "GOOGLE_API_KEY" not in st.secrets:
         return "GOOGLE_API_KEY missing in st.secrets"
 
     try:
-        embeddings = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2",
-            model_kwargs={"device": "cpu"}
-        )
-        db = FAISS.load_local(
-            "faiss_index",
-            embeddings,
-            allow_dangerous_deserialization=True
-        )
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            temperature=0.3,
-            google_api_key=st.secrets["GOOGLE_API_KEY"]
-        )
-        prompt = PromptTemplate.from_template(
-            "背景:{context}\n問題:{question}\n回答 (請簡短，適合語音朗讀):"
-        )
-        return (
-            {"context": db.as_retriever(search_kwargs={"k": 2}),
-             "question": RunnablePassthrough()}
-            | prompt
-            | llm
-            | StrOutputParser()
+        # 索引不進版控 (新 clone / 雲端部署都沒有)；沒有索引或比資料舊 (景點介紹也建在索引裡)，
+        # 就在這個背景執行緒裡重建，地圖照常先畫出來
+        index_pkl = os.path.join(FAISS_DIR, "index.pkl")
+        data_mtime = max(SPOTS_MTIME, os.path.getmtime(RAG_SOURCE_PATH))
+        if not os.path.exists(index_pkl) or os.path.getmtime(index_pkl) < data_mtime:
+            print("📚 FAISS 索引不存在或已過期，重新建立...")
+            guide_core.build_faiss_index(RAG_SOURCE_PATH, SPOTS, FAISS_DIR, get_embeddings())
+
+        db = guide_core.load_faiss_mmap(FAISS_DIR, get_embeddings())
+        # 用各景點名稱查一次，把 mmap 的索引頁面讀進 page cache
+        for info in SPOTS.values():
+            db.similarity_search(info["name"], k=1)
+        return guide_core.make_qa_chain(
+            db, get_embeddings(), st.secrets["GOOGLE_API_KEY"], CONTEXT_MIN_SIM
         )
     except Exception as e:
         return f"RAG Error: {str(e)}"
 
-qa_chain_or_error = load_rag()
+RAG_LOADING = "RAG loading"
+
+@st.cache_resource(max_entries=1)
+def start_rag_loader(spots_mtime, source_mtime):
+    # 模型下載/載入丟到背景執行緒，地圖與 GPS 先畫出來，不用等 RAG；
+    # spots.json 或 rag_source.txt 改了，key 就會變，重新載入 (必要時重建索引)
+    return ThreadPoolExecutor(max_workers=1).submit(load_rag)
+
+def rag_loader():
+    source_mtime = os.path.getmtime(RAG_SOURCE_PATH) if os.path.exists(RAG_SOURCE_PATH) else 0.0
+    return start_rag_loader(SPOTS_MTIME, source_mtime)
+
+def current_qa_chain():
+    # 每次用到時才看背景載入是否完成，只重跑 fragment 時也拿得到剛載好的 chain
+    rag_future = rag_loader()
+    if not rag_future.done():
+        return RAG_LOADING
+    result = rag_future.result()
+    if isinstance(result, str):
+        # 失敗不留在快取裡：補上 API key、重建索引後，下一次提問就會重新載入
+        start_rag_loader.clear()
+    return result
+
+rag_loader()
+
+# 兩層快取，未過期就直接回傳舊答案，不再呼叫 Gemini：
+# 1. 完全相同的問題 (sha256)，連 embedding 都不用算
+# 2. 語意相近的問題 (cosine)；MiniLM 是英文模型，中文相似度容易偏高，門檻寧可嚴一點，
+#    拿別題的答案回覆比多問一次 Gemini 糟得多
+ANSWER_SIM_THRESHOLD = 0.95
+ANSWER_TTL = 3600
+ANSWER_MAX_PER_SPOT = 256  # 每個景點最多留幾筆，超過就丟最舊的
+ANSWER_SEARCH_K = 4  # 語意比對時看前幾名，取第一個夠像又沒過期的
+
+@st.cache_resource
+def get_answer_cache():
+    # exact: sha256 -> (answer, ts)，依寫入時間排序
+    # spots: spot_key -> {"index": IndexFlatIP, "entries": [(向量, answer, ts), ...]}，跨 session 共用
+    return {"lock": threading.Lock(), "exact": {}, "spots": {}}
+
+def _prune_answers(cache, now):
+    """丟掉過期與超量的答案 (呼叫端要持有鎖)；條目依時間順序寫入，過期的一定在最前面"""
+    exact = cache["exact"]
+    while exact and now - next(iter(exact.values()))[1] >= ANSWER_TTL:
+        exact.pop(next(iter(exact)))
+
+    for spot in cache["spots"].values():
+        entries = spot["entries"]
+        expired = 0
+        while expired < len(entries) and now - entries[expired][2] >= ANSWER_TTL:
+            expired += 1
+        drop = max(expired, len(entries) - ANSWER_MAX_PER_SPOT)
+        if not drop:
+            continue
+        del entries[:drop]
+        # IndexFlatIP 不能刪單筆，用剩下的向量重建
+        spot["index"].reset()
+        if entries:
+            spot["index"].add(np.vstack([e[0] for e in entries]))
+
+def ask_rag(chain, spot_key, question):
+    """逐段產生答案給 st.write_stream；快取命中時一次吐出整段"""
+    full_q = f"我現在在「{SPOTS[spot_key]['name']}」，{question}"
+    exact_key = hashlib.sha256(full_q.strip().encode("utf-8")).hexdigest()
+
+    cache = get_answer_cache()
+    with cache["lock"]:
+        _prune_answers(cache, time.time())
+        hit = cache["exact"].get(exact_key)
+    if hit:
+        yield hit[0]
+        return
+
+    # 語意快取本來就依景點分開，只算使用者的問題本身；
+    # 加上共同的「我現在在…」前綴會讓不相干的問題也變得很像
+    qv = np.array([get_embeddings().embed_query(question.strip())], dtype="float32")
+    faiss.normalize_L2(qv)
+
+    hit = None
+    with cache["lock"]:
+        spot = cache["spots"].get(spot_key)
+        if spot and spot["index"].ntotal:
+            now = time.time()
+            sims, ids = spot["index"].search(qv, min(ANSWER_SEARCH_K, spot["index"].ntotal))
+            for sim, i in zip(sims[0], ids[0]):
+                if sim < ANSWER_SIM_THRESHOLD:
+                    break  # 依相似度由高到低排，後面的只會更不像
+                _, answer, ts = spot["entries"][i]
+                if now - ts < ANSWER_TTL:
+                    hit = answer
+                    break
+    # 先放開鎖再交出答案：generator 停在 yield 時 (前端慢、rerun 丟棄) 不能卡住其他 session
+    if hit is not None:
+        yield hit
+        return
+
+    # 串流：第一個 token 到就開始顯示，不用等整段生成完
+    parts = []
+    for chunk in chain.stream(full_q):
+        parts.append(chunk)
+        yield chunk
+
+    answer, now = "".join(parts), time.time()
+    with cache["lock"]:
+        # 重新放到最後面，維持依時間排序
+        cache["exact"].pop(exact_key, None)
+        cache["exact"][exact_key] = (answer, now)
+        if spot_key not in cache["spots"]:
+            cache["spots"][spot_key] = {"index": faiss.IndexFlatIP(qv.shape[1]), "entries": []}
+        spot = cache["spots"][spot_key]
+        spot["index"].add(qv)
+        spot["entries"].append((qv[0], answer, now))
+        _prune_answers(cache, now)
 
 # --------------------------------------------------
 # Logic Functions
 # --------------------------------------------------
+AUDIO_DIR = "data/audio"
+AUDIO_SCAN_SEC = 10
+
+@st.cache_resource(max_entries=1)
+def load_audio_blobs(signature):
+    """把所有 MP3 讀進記憶體 (檔名 -> bytes)，播放時不碰磁碟也不需 base64"""
+    blobs = {}
+    for name, _, _ in signature:
+        try:
+            with open(os.path.join(AUDIO_DIR, name), "rb") as f:
+                blobs[name] = f.read()
+        except FileNotFoundError:
+            # 1_gen_assets.py 重新產生語音時會先刪再寫；掃描後才被刪的檔先略過，寫好後簽章會變而重新讀取
+            continue
+    return blobs
+
+@st.cache_resource(ttl=AUDIO_SCAN_SEC, show_spinner=False)
+def audio_signature():
+    # 以每個檔案的 (檔名, 大小, mtime) 當 key：直接覆寫既有檔案不會改資料夾 mtime，
+    # 但會改到該檔的大小/mtime；讀到寫一半的檔，寫完後 key 也會變而重新讀取
+    entries = []
+    if os.path.isdir(AUDIO_DIR):
+        for e in os.scandir(AUDIO_DIR):
+            if not (e.name.endswith(".mp3") and e.is_file()):
+                continue
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((e.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(entries))
+
+def audio_blobs():
+    # 每次 rerun 都可能用到；資料夾最多每 AUDIO_SCAN_SEC 秒才重新掃一次，其餘只是查快取
+    return load_audio_blobs(audio_signature())
+
+audio_blobs()  # 先把語音讀進快取，第一次按播放不用等讀檔
+
+MAP_CELL_DEG = 1e-4  # 約 11 m
+
+def snap_to_cell(pos):
+    return (round(pos[0] / MAP_CELL_DEG) * MAP_CELL_DEG, round(pos[1] / MAP_CELL_DEG) * MAP_CELL_DEG)
+
+@st.cache_resource(max_entries=1)
+def build_base_map(mtime):
+    """景點標記與觸發圈，只在 spots.json 變動時重建"""
+    m = folium.Map(location=DEFAULT_CENTER, zoom_start=15)
+
+    for key in SPOT_KEYS:
+        info = SPOTS[key]
+        spot_pos = (info["lat"], info["lon"])
+
+        # 標記
+        folium.Marker(spot_pos, popup=info["name"]).add_to(m)
+
+        # 觸發圈
+        folium.Circle(
+            spot_pos,
+            radius=TRIGGER_DIST,
+            fill=True,
+            color="#3388ff",
+            fill_opacity=0.1
+        ).add_to(m)
+
+    return m
+
+# 地圖旁只掛一個固定 key 的 streamlit_js_eval 元件，iframe 跨 rerun 一直存在：
+# 裡面的 watchPosition 只裝一次，有新讀值時由 JS 用 sendDataToPython 主動推回來
+# (最多每 GEO_POLL_SEC 秒推一次，中間的讀值只留最新一筆)，
+# 不必為了重新讀值每個週期換 key、重建元件
+GEO_POLL_SEC = 4
+GEO_WATCH_JS = f"""
+(() => {{
+  let lastSent = 0, timer = null, latest = null;
+  const push = () => {{
+    timer = null;
+    lastSent = Date.now();
+    sendDataToPython({{value: latest, dataType: "json"}});
+  }};
+  navigator.geolocation.watchPosition(
+    p => {{
+      latest = {{coords: {{
+        latitude: p.coords.latitude,
+        longitude: p.coords.longitude,
+        accuracy: p.coords.accuracy
+      }}}};
+      const wait = lastSent + {GEO_POLL_SEC * 1000} - Date.now();
+      if (wait <= 0) push();
+      else if (!timer) timer = setTimeout(push, wait);
+    }},
+    () => {{}},
+    {{enableHighAccuracy: true, maximumAge: 2000}}
+  );
+}})()
+"""
+
+def watch_geolocation():
+    # 回傳 JS 最後一次推回的座標 (還沒定位時是 None)；
+    # js_expressions 不變，元件只在第一次掛上時執行這段 JS，want_output=False 不回傳 eval 的結果
+    return streamlit_js_eval(js_expressions=GEO_WATCH_JS, want_output=False, key="geo_watch")
+
+def update_user_coords(loc):
+    """更新使用者位置，回傳 True 代表第一次定位或移動超過門檻"""
+    if not loc or "coords" not in loc:
+        return False
+
+    new_pos = (loc["coords"]["latitude"], loc["coords"]["longitude"])
+    now = time.time()
+
+    # 指數移動平均：新讀值一定算進去；同一筆讀值 (使用者停下來時 watchPosition 會一直回傳同一點)
+    # 每個輪詢週期也算一次 (取半個週期，容許計時誤差)，平均值才會收斂到停下的位置，
+    # 但同一週期內多次 rerun 不重複累加
+    ema = st.session_state.pos_ema
+    if new_pos != st.session_state.last_coords or now - st.session_state.last_ema_time >= GEO_POLL_SEC / 2:
+        st.session_state.last_coords = new_pos
+        st.session_state.last_ema_time = now
+        if ema is None:
+            ema = new_pos
+        else:
+            ema = tuple(GPS_EMA_ALPHA * n + (1 - GPS_EMA_ALPHA) * e for n, e in zip(new_pos, ema))
+        st.session_state.pos_ema = ema
+
+    # 每次都拿平滑後位置跟目前位置比，讀值沒變也一樣：
+    # 在 GPS_RERUN_MIN_SEC 內被擋下的移動，時間到了就會補上
+    # 只有當平滑後位置改變超過閾值且距上次重畫夠久，或這是第一次定位時，才更新
+    old_pos = st.session_state.user_coords
+    if old_pos is None or (
+        guide_core.approx_dist_m(old_pos, ema) > MOVE_THRESHOLD
+        and now - st.session_state.last_gps_rerun >= GPS_RERUN_MIN_SEC
+    ):
+        st.session_state.user_coords = ema
+        st.session_state.last_gps_rerun = now
+        return True
+    return False
+
 def check_mqtt():
     """檢查是否有新的廣播指令"""
-    if os.path.exists(MQTT_FILE):
-        try:
-            with open(MQTT_FILE, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                if not content: return None
-                data = json.loads(content)
-            
-            server_time = data.get("timestamp", 0)
-            cmd = data.get("cmd", "")
-
-            if server_time > st.session_state.last_mqtt_time:
-                st.session_state.last_mqtt_time = server_time
-                return cmd
-        except (json.JSONDecodeError, OSError):
-            pass # 忽略讀取衝突
+    broadcast = get_mqtt_broadcast()
+    with broadcast["lock"]:
+        server_time = broadcast["timestamp"]
+        cmd = broadcast["cmd"]
+
+    if server_time > st.session_state.last_mqtt_time:
+        st.session_state.last_mqtt_time = server_time
+        return cmd
     return None
 
 # --------------------------------------------------
 # Background worker (只負責觸發 Rerun)
 # --------------------------------------------------
-@st.fragment(run_every=4)  # 放慢到 4 秒，給 GPS 緩衝時間
+@st.fragment(run_every=GEO_POLL_SEC)  # 放慢到 4 秒，給 GPS 緩衝時間
 def background_worker():
-    # 這個 Fragment 的唯一作用就是定期喚醒 Streamlit
-    # 讓主腳本重新執行，進而觸發 GPS 讀取和 MQTT 檢查
+    # 這個 Fragment 定期喚醒 Streamlit，檢查 MQTT 與 GPS，
+    # 有變化才讓主腳本重新執行
     
     # 檢查 MQTT (雖然主腳本也會查，但這裡可以加快反應)
     cmd = check_mqtt()
     if cmd:
         st.session_state.mqtt_action = cmd
-        st.rerun()
+        st.session_state.rerun_pending = True
     
-    # 這裡不做 GPS 讀取，因為 GPS 讀取必須在主線程渲染元件
-    # 單純的 Rerun 就會觸發下方的 get_geolocation
+    # GPS：讀取 watchPosition 的最新座標 (enableHighAccuracy 對 Android 非常重要)
+    # 第一次定位或位置大幅變動，自動 Rerun 以更新地圖
+    if update_user_coords(watch_geolocation()):
+        st.session_state.rerun_pending = True
 
-    # 可以在這裡印個隱形的時間戳，確保它在跑
-    st.empty()
+    # 同一段時間內的事件合併成一次整頁重跑；還在間隔內就留到下一輪
+    if st.session_state.rerun_pending and time.time() - st.session_state.last_rerun >= RERUN_DEBOUNCE_SEC:
+        st.rerun()
 
 # --------------------------------------------------
 # 主程式邏輯
 # --------------------------------------------------
 
 st.title("虎科大智慧導覽")
+st.session_state.last_rerun = time.time()
 
 # 1. 啟動背景計時器 (放在 Sidebar 以免影響排版)
 with st.sidebar:
     st.header("系統狀態")
     background_worker()
     st.info("系統運作中...請保持螢幕開啟")
-    
-    # 2. 獲取 GPS (關鍵修正：放在主線程，不使用變動 Key)
-    # enableHighAccuracy=True 對 Android 非常重要
-    loc = get_geolocation()
 
-# 3. 處理 GPS 數據
-if loc and "coords" in loc:
-    new_lat = loc["coords"]["latitude"]
-    new_lon = loc["coords"]["longitude"]
-    new_pos = (new_lat, new_lon)
+# 整頁重跑本身就會用到最新的位置與指令，背景累積的事件算是處理掉了
+st.session_state.rerun_pending = False
 
-    # 只有當位置改變超過閾值，或這是第一次定位時，才更新
-    old_pos = st.session_state.user_coords
-    
-    if old_pos is None:
-        st.session_state.user_coords = new_pos
-        # 第一次定位不 Rerun，直接往下跑
-    else:
-        dist = geodesic(old_pos, new_pos).meters
-        if dist > MOVE_THRESHOLD:
-            st.session_state.user_coords = new_pos
-            # 位置大幅變動，自動 Rerun 以更新地圖
-            st.rerun()
-
-elif st.session_state.user_coords is None:
-    # 還沒抓到位置時的提示
+# 2. 還沒抓到位置時的提示
+if st.session_state.user_coords is None:
     st.warning("正在獲取精確位置 (Android 請稍候 5-10 秒)...")
 
-# 4. 處理 MQTT 指令
+# 3. 處理 MQTT 指令
 cmd = check_mqtt()
 if cmd:
     st.session_state.mqtt_action = cmd
@@ -238,7 +520,7 @@ if st.session_state.mqtt_action:
     action = st.session_state.mqtt_action
     if action == "sos":
         st.error("【緊急廣播】 校園安全演練！")
-        st.session_state.audio_to_play = "data/audio/alert.mp3"
+        st.session_state.audio_to_play = "alert.mp3"
         time.sleep(3) # 給使用者看一眼
     elif action == "welcome":
         st.balloons()
@@ -247,69 +529,92 @@ if st.session_state.mqtt_action:
     st.session_state.mqtt_action = None
     st.rerun()
 
-# 5. UI 佈局
-col_map, col_info = st.columns([3, 2])
-
-with col_map:
-    # 預設位置
-    center_pos = st.session_state.user_coords if st.session_state.user_coords else (23.7027, 120.4295)
-    zoom = 18 if st.session_state.user_coords else 15
-
-    m = folium.Map(location=center_pos, zoom_start=zoom)
-
-    # 畫使用者
-    if st.session_state.user_coords:
+# 4. UI 佈局
+def render_map(user_coords):
+    # st_folium 設了 returned_objects=[]，拖曳、縮放、點擊都不會觸發 rerun；
+    # 地圖只在整頁 rerun (GPS 移動、MQTT、按鈕) 時重畫
+    # 預設位置；地圖中心對齊約 11 m 的格子，站著不動時 GPS 飄移不會讓地圖一直重新置中
+    center_pos = snap_to_cell(user_coords) if user_coords else DEFAULT_CENTER
+    zoom = 18 if user_coords else 15
+
+    # 畫使用者 (只有這一層每次重畫，景點圖層沿用快取的底圖)
+    user_layer = folium.FeatureGroup(name="user")
+    if user_coords:
         folium.Marker(
-            st.session_state.user_coords,
+            user_coords,
             popup="Current Location",
             icon=folium.Icon(color="red", icon="user")
-        ).add_to(m)
-
-    # 畫景點
-    nearest_key = None
-    min_dist = float("inf")
-
-    for key, info in SPOTS.items():
-        spot_pos = (info["lat"], info["lon"])
+        ).add_to(user_layer)
+
+    # st_folium 會把 user_layer add_to 傳進去的地圖；快取的底圖是所有 session 共用的，
+    # 每次重畫都給它一份複本，使用者標記才不會累積在快取裡、漏到別人的地圖上
+    st_folium(
+        copy.deepcopy(build_base_map(SPOTS_MTIME)),
+        center=center_pos,
+        zoom=zoom,
+        feature_group_to_add=user_layer,
+        width="100%",
+        height=450,
+        key="main_map",
+        returned_objects=[]  # 不回傳點擊/縮放狀態，拖曳地圖不會觸發 rerun
+    )
+
+@st.fragment
+def spot_panel(spot_key):
+    # 切換語言只重跑這一段；按播放仍整頁重跑，讓上方的播放器接手
+    spot = SPOTS[spot_key]
+    lang = st.radio("導覽語言", ["中文", "台語"], horizontal=True, key="lang_select")
+    
+    # 顯示介紹
+    intro_text = spot["intro_cn"] if lang == "中文" else spot.get("intro_tw", "無資料")
+    st.write(intro_text)
+
+    # 手動播放按鈕
+    if st.button("▶ 播放導覽", key="play_guide"):
+        suffix = "cn" if lang == "中文" else "tw"
+        if f"{spot_key}_{suffix}.mp3" not in audio_blobs() and lang == "台語":
+            suffix = "cn" # Fallback
         
-        # 計算距離
-        d = 99999
-        if st.session_state.user_coords:
-            d = geodesic(st.session_state.user_coords, spot_pos).meters
+        st.session_state.audio_to_play = f"{spot_key}_{suffix}.mp3"
+        st.rerun()
 
-        # 標記
-        folium.Marker(
-            spot_pos,
-            popup=f"{info['name']} ({int(d)}m)"
-        ).add_to(m)
+@st.fragment
+def spot_chat(spot_key):
+    # 送出問題只重跑小幫手這一段，上面的介紹、語言選擇、地圖都不動
+    st.divider()
+    st.markdown("**虎科小幫手**")
+    
+    user_q = st.chat_input("關於這裡的問題...", key="spot_question")
+    if user_q:
+        qa_chain_or_error = current_qa_chain()
+        if qa_chain_or_error == RAG_LOADING:
+            st.info("AI 小幫手暖機中，請稍後再問一次...")
+        elif isinstance(qa_chain_or_error, str):
+            st.error(qa_chain_or_error)
+        else:
+            with st.spinner("思考中..."):
+                st.write_stream(ask_rag(qa_chain_or_error, spot_key, user_q))
 
-        # 觸發圈
-        folium.Circle(
-            spot_pos,
-            radius=TRIGGER_DIST,
-            fill=True,
-            color="#3388ff",
-            fill_opacity=0.1
-        ).add_to(m)
+# 找最近景點
+nearest_key, min_dist = None, float("inf")
+if st.session_state.user_coords:
+    nearest_key, min_dist = nearest_spot(st.session_state.user_coords)
 
-        if d < min_dist:
-            min_dist = d
-            nearest_key = key
+col_map, col_info = st.columns([3, 2])
 
-    st_folium(m, width="100%", height=450, key="main_map")
+with col_map:
+    render_map(st.session_state.user_coords)
 
 with col_info:
-    # 6. 播放音效 (隱藏式播放器，利用 state 控制)
-    if st.session_state.audio_to_play:
-        try:
-            st.audio(st.session_state.audio_to_play, format="audio/mp3", autoplay=True)
-            # 播放後清除，避免重整頁面時重播，但要小心清除太快導致沒播出來
-            # 這裡不立即清除，讓使用者下次互動或移動時才消失
-            st.session_state.audio_to_play = None
-        except Exception:
-            pass
-
-    # 7. 抵達判斷
+    # 5. 播放音效 (隱藏式播放器，利用 state 控制)
+    # 先取出再查：播過的不會在下次 rerun 重播，找不到的檔案也不會每次 rerun 都重試
+    audio_name = st.session_state.pop("audio_to_play", None)
+    if audio_name:
+        audio = audio_blobs().get(audio_name)
+        if audio:
+            st.audio(audio, format="audio/mp3", autoplay=True)
+
+    # 6. 抵達判斷
     if st.session_state.user_coords and nearest_key and min_dist <= TRIGGER_DIST:
         spot = SPOTS[nearest_key]
         
@@ -319,35 +624,9 @@ with col_info:
             st.toast(f"已抵達：{spot['name']}")
 
         st.success(f"您在：{spot['name']}")
-        
-        lang = st.radio("導覽語言", ["中文", "台語"], horizontal=True, key="lang_select")
-        
-        # 顯示介紹
-        intro_text = spot["intro_cn"] if lang == "中文" else spot.get("intro_tw", "無資料")
-        st.write(intro_text)
-
-        # 手動播放按鈕
-        if st.button("▶ 播放導覽"):
-            suffix = "cn" if lang == "中文" else "tw"
-            path = f"data/audio/{nearest_key}_{suffix}.mp3"
-            if not os.path.exists(path) and lang == "台語":
-                 path = f"data/audio/{nearest_key}_cn.mp3" # Fallback
-            
-            st.session_state.audio_to_play = path
-            st.rerun()
-
-        st.divider()
-        st.markdown("**虎科小幫手**")
-        
-        user_q = st.chat_input("關於這裡的問題...")
-        if user_q:
-            if isinstance(qa_chain_or_error, str):
-                st.error(qa_chain_or_error)
-            else:
-                with st.spinner("思考中..."):
-                    resp = qa_chain_or_error.invoke(f"我現在在「{spot['name']}」，{user_q}")
-                    st.write(resp)
-                    
+        spot_panel(nearest_key)
+        spot_chat(nearest_key)
+
     elif st.session_state.user_coords:
         if nearest_key:
             st.info(f"距離最近：{SPOTS[nearest_key]['name']} (約 {int(min_dist)} 公尺)")
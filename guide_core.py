@@ -0,0 +1,197 @@
+import os
+import json
+import math
+import pickle
+import tempfile
+import faiss
+import numpy as np
+from scipy.spatial import cKDTree
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.document_loaders import TextLoader
+from langchain_community.vectorstores import FAISS
+from langchain_text_splitters import CharacterTextSplitter
+from langchain_core.documents import Document
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnablePassthrough
+from langchain_classic.retrievers import ContextualCompressionRetriever
+from langchain_classic.retrievers.document_compressors import EmbeddingsFilter
+
+# --------------------------------------------------
+# 共用邏輯 (不依賴 Streamlit)：app.py 與 2_build_index.py 都從這裡取用，
+# 快取交給呼叫端 (st.cache_* / lru_cache) 處理
+# --------------------------------------------------
+EMBED_MODEL = "all-MiniLM-L6-v2"
+EARTH_RADIUS = 6371000.0
+
+# --------------------------------------------------
+# 景點
+# --------------------------------------------------
+def load_spots(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# 以校園中心做切平面投影 (公尺，即 cheap-ruler 等距近似)，
+# 建 KD-tree 找最近景點，景點變多也是 O(log N)
+def to_local_xy(lat, lon, origin):
+    lat0, lon0 = origin
+    x = EARTH_RADIUS * np.cos(np.radians(lat0)) * np.radians(np.asarray(lon) - lon0)
+    y = EARTH_RADIUS * np.radians(np.asarray(lat) - lat0)
+    return np.column_stack([x, y])
+
+def approx_dist_m(a, b):
+    """兩點 (lat, lon) 的等距近似距離 (公尺)；幾十公尺內誤差可忽略，給每次輪詢的移動判斷用"""
+    lat0 = math.radians((a[0] + b[0]) / 2)
+    dx = math.radians(b[1] - a[1]) * math.cos(lat0)
+    dy = math.radians(b[0] - a[0])
+    return EARTH_RADIUS * math.hypot(dx, dy)
+
+def build_spot_index(spots, default_origin):
+    """回傳 (景點 key 順序, 投影原點, KD-tree)"""
+    keys = list(spots)
+    if not keys:
+        return keys, default_origin, None
+    lats = np.array([spots[k]["lat"] for k in keys])
+    lons = np.array([spots[k]["lon"] for k in keys])
+    origin = (lats.mean(), lons.mean())
+    return keys, origin, cKDTree(to_local_xy(lats, lons, origin))
+
+def nearest_spot(spot_index, user_pos):
+    """回傳 (最近景點 key, 距離公尺)；150 m 觸發範圍內平面近似誤差遠小於 1 m"""
+    keys, origin, tree = spot_index
+    if tree is None:
+        return None, float("inf")
+    dist, idx = tree.query(to_local_xy(*user_pos, origin)[0])
+    return keys[idx], float(dist)
+
+# --------------------------------------------------
+# 向量模型與索引
+# --------------------------------------------------
+def make_embeddings(batch_size=64):
+    # 向量已正規化，FAISS 的距離排序等同 cosine
+    return HuggingFaceEmbeddings(
+        model_name=EMBED_MODEL,
+        # ONNX Runtime + 官方預先量化的 int8 權重 (AVX2)，CPU 推論較快、記憶體較小
+        model_kwargs={
+            "device": "cpu",
+            "backend": "onnx",
+            "model_kwargs": {"file_name": "onnx/model_quint8_avx2.onnx"}
+        },
+        encode_kwargs={"batch_size": batch_size, "normalize_embeddings": True}
+    )
+
+# 依段落數挑索引類型：
+# - 少量：flat 暴力搜尋本來就最快且精確
+# - 中量：HNSW 圖索引，查詢 O(log N)；向量以 int8 (SQ8) 存，記憶體約為 1/4
+# - 大量：IVF-PQ 壓縮；PQ 每個子空間要 256 個中心，資料太少訓練不起來
+HNSW_MIN_DOCS = 1000
+QUANTIZE_MIN_DOCS = 10000
+
+def _hnsw(db):
+    xb = db.index.reconstruct_n(0, db.index.ntotal)
+    hnsw = faiss.IndexHNSWSQ(xb.shape[1], faiss.ScalarQuantizer.QT_8bit, 32)
+    hnsw.hnsw.efConstruction = 200
+    hnsw.train(xb)  # SQ8 只需要各維度的最小/最大值
+    hnsw.add(xb)  # 依原順序加入，index_to_docstore_id 不用改
+    hnsw.hnsw.efSearch = 32  # 會跟著索引存檔
+    db.index = hnsw
+
+def _quantize(db):
+    """把 flat fp32 索引換成 IVF-PQ (每個向量 48 bytes，原本 384*4 bytes)"""
+    xb = db.index.reconstruct_n(0, db.index.ntotal)
+    d = xb.shape[1]
+    nlist = max(4, int(math.sqrt(len(xb))))
+
+    # 向量已正規化，L2 與 cosine 排序一致，沿用 LangChain 預設的 L2 分數
+    ivf = faiss.index_factory(d, f"IVF{nlist},PQ{d // 8}x8", faiss.METRIC_L2)
+    ivf.train(xb)
+    ivf.add(xb)  # 依原順序加入，index_to_docstore_id 不用改
+    ivf.nprobe = 8  # 會跟著索引存檔
+    ivf.make_direct_map()  # MMR 檢索需要 reconstruct()
+    db.index = ivf
+
+def _spot_docs(spots):
+    """景點介紹 (中文 / 台語) 也放進索引，跟 rag_source 的段落一起批次算向量"""
+    docs = []
+    for key, info in spots.items():
+        # 台語稿常跟中文一樣，重複的就不再多存一份
+        for text in dict.fromkeys([info.get("intro_cn", ""), info.get("intro_tw", "")]):
+            if text:
+                docs.append(Document(page_content=f"景點：{info['name']}\n{text}", metadata={"spot": key}))
+    return docs
+
+def build_faiss_index(source_path, spots, folder, embeddings):
+    """切段、算向量、依段落數挑索引類型後存到 folder"""
+    loader = TextLoader(source_path, encoding="utf-8")
+    docs = CharacterTextSplitter(chunk_size=300, chunk_overlap=50).split_documents(loader.load())
+    docs += _spot_docs(spots)
+
+    db = FAISS.from_documents(docs, embeddings)
+    if len(docs) >= QUANTIZE_MIN_DOCS:
+        print("🗜️ 段落數量大，壓縮為 IVF-PQ 索引...")
+        _quantize(db)
+    elif len(docs) >= HNSW_MIN_DOCS:
+        print("🕸️ 改用 HNSW 圖索引...")
+        _hnsw(db)
+
+    # 先存到暫存資料夾再逐檔換上去：已經 mmap 舊索引的 process 仍讀舊檔，不會讀到寫一半的檔；
+    # index.pkl 最後換，它的 mtime 就是索引建好的時間
+    parent = os.path.dirname(os.path.abspath(folder))
+    tmp = tempfile.mkdtemp(prefix=".faiss_index_", dir=parent)
+    db.save_local(tmp)
+    os.makedirs(folder, exist_ok=True)
+    for name in ("index.faiss", "index.pkl"):
+        os.replace(os.path.join(tmp, name), os.path.join(folder, name))
+    os.rmdir(tmp)
+
+def load_faiss_mmap(folder, embeddings):
+    """以 mmap 唯讀載入索引，頁面按需讀取，多個 worker 共用 page cache"""
+    # IO_FLAG_MMAP 只 mmap IVF 的 inverted lists，flat / HNSW 仍整份讀進記憶體；
+    # IO_FLAG_MMAP_IFC (faiss >= 1.10) 才會把所有索引類型的向量資料都 mmap
+    index = faiss.read_index(
+        os.path.join(folder, "index.faiss"),
+        faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    )
+    # index.pkl 是 FAISS.save_local 存的 (docstore, index_to_docstore_id)
+    with open(os.path.join(folder, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id
+    )
+
+# --------------------------------------------------
+# 問答鏈
+# --------------------------------------------------
+def make_qa_chain(db, embeddings, api_key, min_sim):
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",
+        temperature=0.3,
+        google_api_key=api_key
+    )
+    prompt = PromptTemplate.from_template(
+        "背景:{context}\n問題:{question}\n回答 (請簡短，適合語音朗讀):"
+    )
+    # MMR：FAISS 先取 10 段 (幾乎不花時間)，再挑 4 段彼此不重複的；
+    # 再依與問題的相似度過濾，最多留 2 段，無關段落不送給 Gemini (省 prompt token)
+    retriever = ContextualCompressionRetriever(
+        base_compressor=EmbeddingsFilter(
+            embeddings=embeddings,
+            similarity_threshold=min_sim,
+            k=2
+        ),
+        base_retriever=db.as_retriever(
+            search_type="mmr",
+            search_kwargs={"k": 4, "fetch_k": 10, "lambda_mult": 0.5}
+        )
+    )
+    return (
+        {"context": retriever,
+         "question": RunnablePassthrough()}
+        | prompt
+        | llm
+        | StrOutputParser()
+    )
@@ -3,7 +3,7 @@ import os
 import toml
 import asyncio
 import base64
-import requests
+import httpx
 import edge_tts
 
 # ==============================
@@ -16,6 +16,31 @@ except Exception:
     print("❌ 無法讀取 YATING_API_KEY")
     exit(1)
 
+# ==============================
+# 共用連線 (重複使用 TCP/TLS，不必每個景點重新握手)
+# ==============================
+YATING_URL = "https://tts.api.yating.tw/v2/speeches/short"
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+MAX_RETRIES = 3
+
+# 同時處理的景點數上限 (避免超過 Edge TTS / 雅婷的速率限制)
+MAX_CONCURRENCY = 8
+
+# HTTP/2：多個景點的請求共用同一條 TCP+TLS 連線 (多工)，也不用 to_thread
+_HX = httpx.AsyncClient(
+    timeout=20,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=MAX_RETRIES,
+        limits=httpx.Limits(max_keepalive_connections=10)
+    ),
+    headers={
+        "Content-Type": "application/json",
+        "Key": YATING_KEY
+    }
+)
+
 # ==============================
 # 2️⃣ 中文語音（Edge TTS）
 # ==============================
@@ -34,16 +59,9 @@ async def gen_cn_mp3(text, path):
 # ==============================
 # 3️⃣ 台語語音（雅婷 TTS v2）
 # ==============================
-def gen_tw_mp3(text, path):
+async def gen_tw_mp3(text, path):
     print("   🎙️ [台語] 生成中...")
 
-    url = "https://tts.api.yating.tw/v2/speeches/short"
-
-    headers = {
-        "Content-Type": "application/json",
-        "Key": YATING_KEY
-    }
-
     payload = {
         "input": {
             "text": text,
@@ -62,7 +80,12 @@ def gen_tw_mp3(text, path):
     }
 
     try:
-        res = requests.post(url, headers=headers, json=payload, timeout=20)
+        # 連線錯誤由 transport 重試；429/5xx 在這裡退避重試
+        for attempt in range(MAX_RETRIES + 1):
+            res = await _HX.post(YATING_URL, json=payload)
+            if res.status_code not in RETRY_STATUS or attempt == MAX_RETRIES:
+                break
+            await asyncio.sleep(0.5 * 2 ** attempt)
 
         # ❌ HTTP 錯誤（不印 body，避免亂碼）
         if res.status_code not in (200, 201):
@@ -80,44 +103,39 @@ def gen_tw_mp3(text, path):
             print("      ❌ 回傳缺少 audioContent")
             return
 
-        audio_bytes = base64.b64decode(audio_b64)
-
+        # 解碼後直接寫檔，不另外留一份 bytes；回應本體也先釋放
+        del res, data
         with open(path, "wb") as f:
-            f.write(audio_bytes)
+            f.write(base64.b64decode(audio_b64))
 
         print("      ✅ 台語完成")      
 
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print("      ❌ 連線逾時")
-    except requests.exceptions.RequestException:
+    except httpx.HTTPError:
         print("      ❌ API 連線錯誤")
     except Exception:
         print("      ❌ 未知錯誤")
 
 # ==============================
-# 4️⃣ 主程式
+# 4️⃣ 單一景點 (中文、台語同時生成)
 # ==============================
-async def main():
-    json_path = "data/spots.json"
-
-    if not os.path.exists(json_path):
-        print("❌ 找不到 data/spots.json")
-        return
-
-    os.makedirs("data/audio", exist_ok=True)
-
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    print("🚀 開始生成語音檔...")
+def _size_or_zero(path):
+    # 一次 stat 同時得知存在與大小，不存在視為 0
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
 
-    for key, info in data.items():
+async def process_spot(key, info, sem):
+    async with sem:
         print(f"\n📍 {info['name']}")
+        jobs = []
 
         # 中文
         cn_path = f"data/audio/{key}_cn.mp3"
-        if not os.path.exists(cn_path):
-            await gen_cn_mp3(info["intro_cn"], cn_path)
+        if _size_or_zero(cn_path) == 0:
+            jobs.append(gen_cn_mp3(info["intro_cn"], cn_path))
         else:
             print("   ℹ️ 中文檔已存在")
 
@@ -125,19 +143,49 @@ async def main():
         tw_text = info.get("intro_tw", info["intro_cn"])
         tw_path = f"data/audio/{key}_tw.mp3"
 
-        # 刪除 0kb 壞檔
-        if os.path.exists(tw_path) and os.path.getsize(tw_path) < 100:
+        # 刪除 0kb 壞檔 (刪掉後就當作不存在)
+        tw_size = _size_or_zero(tw_path)
+        if 0 < tw_size < 100:
             os.remove(tw_path)
+            tw_size = 0
 
-        if not os.path.exists(tw_path):
-            gen_tw_mp3(tw_text, tw_path)
+        if tw_size == 0:
+            jobs.append(gen_tw_mp3(tw_text, tw_path))
         else:
             print("   ℹ️ 台語檔已存在")
 
+        await asyncio.gather(*jobs)
+
+# ==============================
+# 5️⃣ 主程式
+# ==============================
+async def main():
+    json_path = "data/spots.json"
+
+    if not os.path.exists(json_path):
+        print("❌ 找不到 data/spots.json")
+        return
+
+    os.makedirs("data/audio", exist_ok=True)
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    print("🚀 開始生成語音檔...")
+
+    # 各景點同時送出 (網路 I/O 為主)，以 Semaphore 限制同時數量
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    tasks = [process_spot(key, info, sem) for key, info in data.items()]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for key, result in zip(data, results):
+        if isinstance(result, Exception):
+            print(f"   ❌ {key} 處理失敗: {result}")
+
+    await _HX.aclose()
     print("\n🎉 全部完成")
 
 # ==============================
-# 5️⃣ 程式入口
+# 6️⃣ 程式入口
 # ==============================
 if __name__ == "__main__":
     asyncio.run(main())